@@ -1,11 +1,56 @@
 # Auth.py contains the classes in order to use the authentication methods in the FastAPIDecorator.
-# This file also allows you to add new users to the credentials file.
+# This file also allows you to add new users to the credentials file, by running `python Auth.py`.
+
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.security import HTTPBasic
+import asyncio
+import atexit
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+
+import bcrypt
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from argon2.profiles import RFC_9106_LOW_MEMORY
+
+BCRYPT_PREFIXES = (b"$2a$", b"$2b$", b"$2y$")
+TOKEN_PREFIX = b"$hmac-sha256$"
+# stored hashes asking for more work than this are refused without being checked
+MAX_BCRYPT_COST = 14
+MAX_ARGON2_TIME_COST = 16
+MAX_ARGON2_MEMORY_COST = 256 * 1024  # in KiB
+
+
+def benchmark_cost(target_ms: float = 250.0, memory_cost: int = RFC_9106_LOW_MEMORY.memory_cost) -> int:
+    """
+    Finds the Argon2id time cost whose hashing time is the closest to target_ms (without exceeding it) on this host.
+    Args:
+        target_ms (float): The hashing time we aim for, in milliseconds.
+        memory_cost (int): The Argon2 memory cost used for the measure, in KiB.
+    Returns:
+        int: The time cost to pass to UserCredentialsDB, at least 1.
+    """
+    low, high = 1, MAX_ARGON2_TIME_COST
+    while low < high:
+        middle = (low + high + 1) // 2
+        hasher = PasswordHasher(time_cost=middle, memory_cost=memory_cost)
+        start = time.perf_counter()
+        hasher.hash("benchmark")
+        if (time.perf_counter() - start) * 1000 <= target_ms:
+            low = middle
+        else:
+            high = middle - 1
+    return low
 
-from fastapi import Depends, HTTPException, status
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
-import json
-import bcrypt 
-from typing import Dict
 
 class UserCredentialsDB:
     """
@@ -13,80 +58,329 @@ class UserCredentialsDB:
 
     Attributes:
         filepath (str): The path to the file where user credentials are stored. Here, it's user_credentials.json.
-        credentials (Dict[str, str]): A dictionary to store user credentials, with usernames as keys and hashed passwords as values.
+        log_path (str): The path to the append-only log of the changes made since the last compaction. Here, it's user_credentials.log.
+        credentials (Dict[str, bytes]): A dictionary to store user credentials, with usernames as keys and hashed passwords as values.
+            The hashes are kept as bytes in memory so that they can be checked without being re-encoded on every request.
 
     Methods:
-        add_user(username, password): Adds a new user with a hashed password to the credentials dictionary and saves it to the file.
+        add_user(username, password): Adds a new user with a hashed password to the credentials dictionary and appends it to the log.
+        add_users(users): Adds several (username, password) pairs at once, hashing the passwords in parallel and appending them to the log in a single write.
+        add_token(name, token): Adds a high-entropy token (API key, session id...) stored as an HMAC-SHA256 instead of a password hash.
         validate_user(username, password): Validates a user's credentials against the stored hashed password.
-        save_credentials(): Saves the current state of the credentials dictionary to a file.
-        load_credentials(): Loads credentials from a file into the credentials dictionary.
-        delete_user(username, password): Removes the user if the password matches from credentials dictionary and saves the updated file.
+        validate_token(name, token): Validates a token against the stored HMAC, in constant time.
+        is_token(name): Checks whether the stored credential is a token rather than a password.
+        users_needing_rehash(): Lists the users whose password hash is legacy bcrypt or uses other Argon2 parameters than the current ones.
+        append_record(username, hashed_password): Appends one change to the log (a None hash is a tombstone for a deleted user).
+        append_records(records): Appends several (username, hashed_password) changes to the log in a single write.
+        compact(): Rewrites the whole credentials dictionary to the credentials file and empties the log.
+        load_credentials(): Loads credentials from the file, then replays the log into the credentials dictionary.
+        close(): Closes the log file, which otherwise stays open until the process exits once something was appended.
+        delete_user(username, password): Removes the user if the password matches from credentials dictionary and appends a tombstone to the log.
+
+    Each change costs one JSON line in the log instead of a rewrite of the whole file, written through a handle
+    opened on the first change rather than on every change. The log is compacted
+    into the credentials file once it holds more than twice as many records as there are users.
+
+    New passwords are hashed with Argon2id. Every stored hash carries its algorithm id as a prefix
+    ("$argon2id$..." or "$2b$..."), so hashes created with bcrypt before the switch keep validating.
+    The Argon2 cost is set with time_cost and memory_cost (see benchmark_cost to tune it for the host), and stored
+    hashes whose cost exceeds MAX_BCRYPT_COST or the MAX_ARGON2_* limits are rejected without being checked.
+    Tokens are uniformly random, so a slow password hash brings them nothing: they are stored as an HMAC-SHA256
+    ("$hmac-sha256$...") keyed with server_key, which defaults to the AUTH_SECRET_KEY environment variable.
 
+    The result of each password check is kept in a small TTL/LRU cache keyed by (username, sha256(password)),
+    so that HTTP Basic clients replaying the same credentials on every request only pay for bcrypt once per TTL window.
+    Failed checks are cached too, so that hammering a route with a wrong password does not cost a bcrypt call per request.
     """
-    def __init__(self, filepath='user_credentials.json'):
+    def __init__(self, filepath='user_credentials.json', cache_size: int = 4096, cache_ttl: float = 60.0,
+                 time_cost: int = RFC_9106_LOW_MEMORY.time_cost, memory_cost: int = RFC_9106_LOW_MEMORY.memory_cost,
+                 server_key: Optional[bytes] = None):
         self.filepath = filepath
-        self.credentials: Dict[str, str] = {}
-        self.credentials = self.load_credentials()
+        self.log_path = os.path.splitext(filepath)[0] + '.log'
+        self._log_records = 0
+        self.credentials: Dict[str, bytes] = self.load_credentials()
+        self._log_file = None  # opened on the first append
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._validation_cache: "OrderedDict[Tuple[str, bytes], Tuple[bool, float]]" = OrderedDict()
+        # validate_user runs on the thread pool of get_current_user, so every access to the cache holds this lock
+        self._cache_lock = threading.Lock()
+        # bumped by every clear, so that a check started before a clear does not cache its outdated result
+        self._cache_generation = 0
+        self.password_hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost)
+        self._server_key = server_key if server_key is not None else os.environ.get("AUTH_SECRET_KEY", "").encode()
 
     def add_user(self, username: str, password: str):
-        hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
-        self.credentials[username] = hashed_password.decode('utf-8')
-        self.save_credentials()
+        self.credentials[username] = self.password_hasher.hash(password).encode('ascii')
+        self._clear_validation_cache()
+        self.append_record(username, self.credentials[username])
+
+    def add_users(self, users: List[Tuple[str, str]]):
+        # argon2 releases the GIL while hashing, so the hashes are computed on all the cores
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            hashed_passwords = executor.map(self.password_hasher.hash, [password for _, password in users])
+            records = [(username, hashed_password.encode('ascii'))
+                       for (username, _), hashed_password in zip(users, hashed_passwords)]
+        self.credentials.update(records)
+        self._clear_validation_cache()
+        self.append_records(records)
+
+    def add_token(self, name: str, token: str):
+        if not self._server_key:
+            raise RuntimeError("Set the AUTH_SECRET_KEY environment variable to store tokens.")
+        self.credentials[name] = self._hash_token(token.encode())
+        self._clear_validation_cache()
+        self.append_record(name, self.credentials[name])
+
+    def validate_token(self, name: str, token: Union[str, bytes]) -> bool:
+        hashed_token = self.credentials.get(name)
+        if not hashed_token or not hashed_token.startswith(TOKEN_PREFIX) or not self._server_key:
+            return False
+        if isinstance(token, str):
+            token = token.encode()
+        return hmac.compare_digest(hashed_token, self._hash_token(token))
+
+    def is_token(self, name: str) -> bool:
+        hashed_token = self.credentials.get(name)
+        return hashed_token is not None and hashed_token.startswith(TOKEN_PREFIX)
+
+    def users_needing_rehash(self) -> List[str]:
+        users = []
+        for username, hashed_password in self.credentials.items():
+            if hashed_password.startswith(TOKEN_PREFIX):
+                continue
+            if hashed_password.startswith(BCRYPT_PREFIXES):
+                users.append(username)
+                continue
+            try:
+                if self.password_hasher.check_needs_rehash(hashed_password.decode('ascii')):
+                    users.append(username)
+            except InvalidHashError:
+                users.append(username)
+        return users
+
+    def _hash_token(self, token: bytes) -> bytes:
+        return TOKEN_PREFIX + hmac.new(self._server_key, token, hashlib.sha256).hexdigest().encode('ascii')
+
+    def validate_user(self, username: str, password: Union[str, bytes]) -> bool:
+        # the plaintext password is never kept in the cache, only its sha256 digest
+        encoded_password = password.encode() if isinstance(password, str) else password
+        key = (username, hashlib.sha256(encoded_password).digest())
+        now = time.monotonic()
+        with self._cache_lock:
+            cached = self._validation_cache.get(key)
+            if cached is not None and cached[1] > now:
+                self._validation_cache.move_to_end(key)
+                return cached[0]
+            generation = self._cache_generation
 
-    def validate_user(self, username: str, password: str) -> bool:
         hashed_password = self.credentials.get(username)
+        valid = False
         if hashed_password:
-            return bcrypt.checkpw(password.encode(), hashed_password.encode('utf-8'))
-        return False
+            valid = self._check_password(encoded_password, hashed_password)
+
+        with self._cache_lock:
+            if generation != self._cache_generation:
+                return valid
+            self._validation_cache[key] = (valid, now + self.cache_ttl)
+            self._validation_cache.move_to_end(key)
+            if len(self._validation_cache) > self.cache_size:
+                self._validation_cache.popitem(last=False)
+        return valid
 
-    def save_credentials(self):
-        with open(self.filepath, 'w') as file:
-            json.dump(self.credentials, file)
+    def _clear_validation_cache(self):
+        with self._cache_lock:
+            self._validation_cache.clear()
+            self._cache_generation += 1
+
+    def _check_password(self, password: bytes, hashed_password: bytes) -> bool:
+        if hashed_password.startswith(TOKEN_PREFIX):
+            return bool(self._server_key) and hmac.compare_digest(hashed_password, self._hash_token(password))
+        # compatibility branch for the hashes written before the switch to Argon2id
+        if hashed_password.startswith(BCRYPT_PREFIXES):
+            cost = hashed_password[4:6]
+            if not cost.isdigit() or int(cost) > MAX_BCRYPT_COST:
+                return False
+            return bcrypt.checkpw(password, hashed_password)
+        try:
+            # "$argon2id$v=19$m=65536,t=3,p=4$<salt>$<hash>", read as bytes to avoid decoding the stored hash
+            parameters = dict(parameter.split(b"=") for parameter in hashed_password.split(b"$")[3].split(b","))
+            if int(parameters[b"t"]) > MAX_ARGON2_TIME_COST or int(parameters[b"m"]) > MAX_ARGON2_MEMORY_COST:
+                return False
+            return self.password_hasher.verify(hashed_password, password)
+        except (VerificationError, InvalidHashError, IndexError, KeyError, ValueError):
+            return False
+
+    def append_record(self, username: str, hashed_password: Optional[bytes]):
+        self.append_records([(username, hashed_password)])
+
+    def append_records(self, records: List[Tuple[str, Optional[bytes]]]):
+        lines = b"".join(self._encode_record(username, hashed_password) for username, hashed_password in records)
+        if self._log_file is None:
+            self._log_file = open(self.log_path, 'ab')
+            atexit.register(self.close)
+        self._log_file.write(lines)
+        self._log_file.flush()
+        self._log_records += len(records)
+        if self._log_records > 2 * max(len(self.credentials), 1):
+            self.compact()
+
+    @staticmethod
+    def _encode_record(username: str, hashed_password: Optional[bytes]) -> bytes:
+        # a None hash is written as null, the tombstone of a deleted user
+        hashed_password = hashed_password.decode('ascii') if hashed_password is not None else None
+        return orjson.dumps({"username": username, "hash": hashed_password}) + b"\n"
+
+    def compact(self):
+        # the new file is renamed over the old one, so a crash never leaves a half-written credentials file
+        tmp_path = self.filepath + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(orjson.dumps({username: hashed_password.decode('ascii')
+                                     for username, hashed_password in self.credentials.items()}))
+        os.replace(tmp_path, self.filepath)
+        if self._log_file is None:
+            open(self.log_path, 'wb').close()
+        else:
+            self._log_file.truncate(0)
+        self._log_records = 0
+
+    def close(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+            atexit.unregister(self.close)
 
     def load_credentials(self):
+        credentials = {}
         try:
-            with open(self.filepath, 'r') as file:
-                return json.load(file)
+            with open(self.filepath, 'rb') as file:
+                credentials = {username: hashed_password.encode('ascii')
+                               for username, hashed_password in orjson.loads(file.read()).items()}
         except FileNotFoundError:
-            return {}
+            pass
+
+        self._log_records = 0
+        try:
+            with open(self.log_path, 'rb') as file:
+                log = file.read()
+        except FileNotFoundError:
+            return credentials
+
+        lines = log.split(b"\n")
+        # whatever follows the last newline comes from an append that did not complete (a crash or a full disk)
+        tail = lines.pop()
+        records = [orjson.loads(line) for line in lines if line.strip()]
+        if tail.strip():
+            with open(self.log_path, 'r+b') as file:
+                try:
+                    records.append(orjson.loads(tail))
+                    # the record is whole, only its newline is missing: add it so that the next append starts on a fresh line
+                    file.seek(0, os.SEEK_END)
+                    file.write(b"\n")
+                except orjson.JSONDecodeError:
+                    # a torn record: drop it, so that the next append does not get joined onto it
+                    file.truncate(len(log) - len(tail))
+
+        # last write wins, tombstones delete
+        for record in records:
+            if record["hash"] is None:
+                credentials.pop(record["username"], None)
+            else:
+                credentials[record["username"]] = record["hash"].encode('ascii')
+        self._log_records = len(records)
+        return credentials
     
     def delete_user(self, username: str, password: str):
         if self.validate_user(username, password):
             del self.credentials[username]
-            self.save_credentials()
+            self._clear_validation_cache()
+            self.append_record(username, None)
             return True
         return False
     
+def unauthorized(detail: str, realm: Optional[str] = None) -> HTTPException:
+    return HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                         detail=detail,
+                         headers={"WWW-Authenticate": f'Basic realm="{realm}"' if realm else "Basic"})
+
+
+class BasicCredentials(HTTPBasic):
+    """
+    HTTP Basic security scheme reading the credentials straight from the Authorization header.
+    The parent HTTPBasic builds an HTTPBasicCredentials model on every request; this one returns a plain tuple,
+    while still being registered as the security scheme of the protected routes in the OpenAPI schema
+    (and the /docs "Authorize" button). Like the parent, it honours auto_error and realm.
+    """
+    async def __call__(self, request: Request) -> Optional[Tuple[str, bytes]]:
+        """
+        Args:
+            request (Request): The incoming request.
+        Returns:
+            Tuple[str, bytes]: The username, and the password left as bytes since that is what the hashes are checked against.
+                None if the header is missing or is not Basic and auto_error is False.
+        Raises:
+            HTTPException: A 401 Unauthorized error if the header is malformed, or missing when auto_error is True.
+        """
+        authorization = request.headers.get("authorization")
+        scheme, _, encoded_credentials = (authorization or "").partition(" ")
+        if not encoded_credentials or scheme.lower() != "basic":
+            if self.auto_error:
+                raise unauthorized("Not authenticated", self.realm)
+            return None
+        try:
+            username, separator, password = base64.b64decode(encoded_credentials).partition(b":")
+            if not separator:
+                raise ValueError
+            return username.decode(), password
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise unauthorized("Invalid authentication credentials", self.realm)
+
 ################# USE CASES #################
 user_db = UserCredentialsDB()
-security = HTTPBasic()
+security = BasicCredentials(scheme_name="HTTPBasic")
 
 
-def get_current_user(credentials: HTTPBasicCredentials = Depends(security)):
+async def get_current_user(credentials: Optional[Tuple[str, bytes]] = Depends(security)):
     """
     Authenticates a user based on HTTP Basic Credentials.
+    The password check runs in the default thread pool so that it does not block the event loop,
+    while tokens are checked directly since an HMAC only takes a few microseconds.
     Args:
-        credentials (HTTPBasicCredentials): The credentials provided in the request.
+        credentials (Tuple[str, bytes]): The username and password provided in the request.
     Returns:
         str: The username of the authenticated user.
     Raises:
         HTTPException: If authentication fails, it raises a 401 Unauthorized error with a detailed message.
     This function is designed to be used as a dependency in FastAPI route handlers to enforce authentication.
     """
-    
-    if not user_db.validate_user(credentials.username, credentials.password):
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                            detail="Incorrect username or password",
-                            headers={"WWW-Authenticate": "Basic"})
+    if credentials is None:
+        raise unauthorized("Not authenticated", security.realm)
+    username, password = credentials
+    if user_db.is_token(username):
+        valid = user_db.validate_token(username, password)
+    else:
+        loop = asyncio.get_running_loop()
+        valid = await loop.run_in_executor(None, user_db.validate_user, username, password)
+    if not valid:
+        raise unauthorized("Incorrect username or password")
+
+    return username
 
-    return credentials.username
 
+def seed(db: UserCredentialsDB = user_db):
+    """
+    Adds the example users to the credentials database, skipping the ones that are already there.
+    It is not run on import, so importing Auth does not pay for any password hashing: run `python Auth.py` instead.
+    Args:
+        db (UserCredentialsDB): The credentials database to fill.
+    """
+    users = [("Meghna", "M272"), ("user1", "password1")]
+    missing_users = [(username, password) for username, password in users if username not in db.credentials]
+    if missing_users:
+        db.add_users(missing_users)
 
-# Database handling : adding users to the database
-user_db.add_user("Meghna", "M272")
-user_db.add_user("user1", "password1")
-user_db.add_user("TEST", "test1")
 
-# Deleting users to the database
-user_db.delete_user("TEST", "test1")
+if __name__ == "__main__":
+    # Database handling : adding users to the database
+    seed()
 
@@ -2,13 +2,61 @@
 
 from fastapi import FastAPI, HTTPException, Request, status, Depends
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
 from slowapi.util import get_remote_address
-from fastapi.responses import JSONResponse
+from limits import parse
+from limits.storage import storage_from_string
+from limits.aio.strategies import MovingWindowRateLimiter
+from fastapi.responses import JSONResponse, Response
 from fastapi.exceptions import RequestValidationError
+from starlette.routing import compile_path
 import uvicorn
-from functools import wraps
+import orjson
+import os
+from importlib.util import find_spec
+from Auth import get_current_user
+
+# C event loop and HTTP parser for uvicorn, when they are installed (uvloop is not available on Windows)
+SERVER_LOOP = "uvloop" if find_spec("uvloop") else "asyncio"
+SERVER_HTTP = "httptools" if find_spec("httptools") else "h11"
+
+# shared by every builder of the process, so that their rate-limit counters are not split.
+# With several workers, set RATE_LIMIT_STORAGE_URI (e.g. "redis://localhost:6379") so that they share the counters too.
+# The storage is the asyncio one of limits, so that the middleware does not block the event loop on a hit.
+RATE_LIMIT_STORAGE_URI = os.environ.get("RATE_LIMIT_STORAGE_URI", "memory://")
+if not RATE_LIMIT_STORAGE_URI.startswith("async+"):
+	RATE_LIMIT_STORAGE_URI = "async+" + RATE_LIMIT_STORAGE_URI
+limiter = MovingWindowRateLimiter(storage_from_string(RATE_LIMIT_STORAGE_URI))
+
+
+class RateLimitMiddleware:
+	"""
+	ASGI middleware applying the rate limits of the builder before the request reaches the router.
+	It also makes the builder add the routes still missing from the app before handling a request.
+
+	Attributes:
+		app: The ASGI application to call when the request is within its limit.
+		builder (FastApiDecoratorBuilder): The builder holding the rate limit of each path.
+	"""
+	def __init__(self, app, builder):
+		self.app = app
+		self.builder = builder
+
+	async def __call__(self, scope, receive, send):
+		# routes declared after startup (or on an app whose lifespan is not run, e.g. a plain TestClient) are added here
+		if self.builder.built_routes != len(self.builder.routes):
+			self.builder.build()
+		if scope["type"] == "http":
+			for route_path, (path_regex, methods, rate_limit) in self.builder.rate_limits.items():
+				if scope["method"] in methods and path_regex.match(scope["path"]):
+					# the hits are counted per route, so /items/1 and /items/2 share the limit of /items/{item_id}
+					if not await limiter.hit(rate_limit, route_path, get_remote_address(Request(scope))):
+						response = JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+												content={"detail": "You have exceeded the rate limit."})
+						await response(scope, receive, send)
+						return
+					break
+		await self.app(scope, receive, send)
+
 
 class FastApiDecoratorBuilder:
 	"""
@@ -16,11 +64,13 @@ class FastApiDecoratorBuilder:
 
 	Attributes:
 		app (FastAPI): The FastAPI application instance.
-		routes (list): A list to store information about the routes.
+		routes (list): A list to store information about the routes. They are only added to the app by build().
+		rate_limits (dict): The compiled path regex, methods and rate limit of each rate-limited route path, applied by RateLimitMiddleware.
 		methodsDefault (list): Default HTTP methods for routes.
 		server_started (bool): A flag to check if the server has been started.
 		methodsAutomatic (bool): A flag to automatically set HTTP methods.
 		title (str): The title of the API.
+		root_content (bytes): The JSON body of the root route, encoded once each time the title changes.
 	"""
 
 	def __init__(self):
@@ -29,19 +79,27 @@ class FastApiDecoratorBuilder:
 		"""
 		self.app = FastAPI()
 		self.routes = []  # store info on the routes
+		self.built_routes = 0  # number of routes already added to the app by build()
+		self.rate_limits = {}
 		self.methodsDefault = ["GET"]  #  method to store the routes
 		self.server_started = False # if False -> it will create the server
 		self.methodsAutomatic = True
 		self.title = "FastAPI Decorator Builder API"
-		self.limiter = Limiter(key_func=get_remote_address)
-		self.app.state.limiter = self.limiter
-		self.app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+		self.root_content = self.render_root()
+		self.app.add_middleware(RateLimitMiddleware, builder=self)
+		self.app.add_event_handler("startup", self.build)
 		self.setup_exception_handlers()
 
 		# Define root route
 		@self.app.get("/")
-		def read_root():
-				return {"Hello": "Welcome to the " + self.title + " API!"}
+		async def read_root():
+				return Response(content=self.root_content, media_type="application/json")
+
+	def render_root(self):
+		"""
+		Encode the JSON body returned by the root route.
+		"""
+		return orjson.dumps({"Hello": "Welcome to the " + self.title + " API!"})
 	
 	def setup_exception_handlers(self):
 		@self.app.exception_handler(HTTPException)
@@ -59,11 +117,6 @@ class FastApiDecoratorBuilder:
 			return JSONResponse(status_code=500,
 								content={"detail": "An internal server error occurred."})
 		
-		@self.app.exception_handler(RateLimitExceeded)
-		def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
-			return JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-								content={"detail": "You have exceeded the rate limit."})
-		
 
 	def api_route(self, path: str = "", methods: list = None, run_server=False, auth_required=False, rate_limit=None):
 		"""
@@ -82,50 +135,51 @@ class FastApiDecoratorBuilder:
 				run_server (bool, optional): Flag to run the server after adding the route.
 
 			Returns:
-				callable: The wrapper function.
+				callable: The endpoint function.
         	"""
-			nonlocal path, methods
+			# this allows to dynamically set the route name to the function name
+			route_path = "/" + (path or func.__name__)
+			route_methods = self.methodsDefault if self.methodsAutomatic else methods
 
-			if not path: # this allows to dynamically set the route name to the function name
-				path = "/" + func.__name__ 
-			else:
-				path = "/" + path
-
-			if self.methodsAutomatic:
-				methods = self.methodsDefault
+			if rate_limit:
+				path_regex, _, _ = compile_path(route_path)
+				# like Starlette, a GET route also answers HEAD requests
+				limited_methods = set(route_methods) | ({"HEAD"} if "GET" in route_methods else set())
+				self.rate_limits[route_path] = (path_regex, limited_methods, parse(rate_limit))
 
-			route_info = {"path": path, "methods": methods, "function": func}
-			self.routes.append(route_info)
+			# the authentication is a FastAPI dependency of the route, so the endpoint itself is registered without any wrapper
+			dependencies = [Depends(get_current_user)] if auth_required else None
 
-			if rate_limit:
-				func = self.limiter.limit(rate_limit)(func)
-				
-			@wraps(func)
-			def wrapper(*args, **kwargs):
-				"""
-				Wrapper function which authenticates if auth_required=True before runnning the rest of the code
-				"""
-				if auth_required:
-					pass
-				return func(*args, **kwargs)
-
-			self.app.add_api_route(path, wrapper, methods=methods)
-
-			#here, the api calls the route class and creates a server. This allows for concise comprehension
-			route = Route(self, path, methods, wrapper)
+			#here, the api calls the route class, which stores the route until build() and creates a server. This allows for concise comprehension
+			route = Route(self, route_path, route_methods, func, dependencies)
 			route.create(run_server=run_server)
 
-			return wrapper
+			return func
 
 		return decorator
 
 	
-	def run(self, host="0.0.0.0", port=8001):
+	def build(self):
+		"""
+		Add the routes declared since the last call to the router of the FastAPI application, all at once.
+		It is called by run() and on startup, and before the first request reaches an app that was not built yet.
+		"""
+		for route_info in self.routes[self.built_routes:]:
+			self.app.router.add_api_route(route_info["path"], route_info["function"], methods=route_info["methods"],
+										  dependencies=route_info["dependencies"])
+		self.built_routes = len(self.routes)
+		# the schema is cached by FastAPI, it has to be generated again with the new routes
+		self.app.openapi_schema = None
+
+	def run(self, host="0.0.0.0", port=8001, access_log=False):
 		"""
 		Start the FastAPI application server.
+		The event loop and HTTP parser are the C ones (uvloop and httptools) when they are installed,
+		and the access log is off by default to avoid formatting a log line on every request.
 		"""
 		if not self.server_started:
-			uvicorn.run(self.app, host=host, port=port)
+			self.build()
+			uvicorn.run(self.app, host=host, port=port, loop=SERVER_LOOP, http=SERVER_HTTP, access_log=access_log)
 			self.server_started = True
 		#else:
 		#	print("Server already running. Restart the server to activate new routes.")
@@ -139,6 +193,7 @@ class FastApiDecoratorBuilder:
 		self.title = config["title"]
 		self.methodsDefault = config["methodsDefault"]
 		self.app.title = self.title
+		self.root_content = self.render_root()
 
 class Route:
 	"""
@@ -149,8 +204,9 @@ class Route:
         url (str): The URL path for the route.
         method (str): The HTTP method for the route.
         callback (callable): The callback function for the route.
+        dependencies (list): The FastAPI dependencies run before the callback, e.g. the authentication.
     """
-	def __init__(self, builder, url, method, callback):
+	def __init__(self, builder, url, method, callback, dependencies=None):
 		"""
 		Initialisation of the Route instance. 
 		It takes builder as an argument(FastApiDecoratorBuilder) -> The FastAPI decorator builder instance.
@@ -159,11 +215,13 @@ class Route:
 		self.url = url
 		self.method = method
 		self.callback = callback
+		self.dependencies = dependencies
 
 	def create(self, run_server=False):
 		"""
-		Create and add the route to the FastAPI application.
+		Create the route and store it in the builder, which adds it to the FastAPI application on build().
 		"""
-		self.builder.app.add_api_route(self.url, self.callback, methods=self.method)
+		route_info = {"path": self.url, "methods": self.method, "function": self.callback, "dependencies": self.dependencies}
+		self.builder.routes.append(route_info)
 		if run_server and not self.builder.server_started:
 			self.builder.run()
@@ -1,8 +1,17 @@
 import unittest
+from fastapi import Depends, FastAPI
 from fastapi.testclient import TestClient
 from FastApiDecorator import FastApiDecoratorBuilder
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from Auth import security
+from Auth import security, BasicCredentials, UserCredentialsDB, benchmark_cost, seed, MAX_ARGON2_TIME_COST
+import bcrypt
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+from unittest import mock
 
 class TestFastApiDecoratorBuilder(unittest.TestCase):
 
@@ -32,11 +41,281 @@ class TestFastApiDecoratorBuilder(unittest.TestCase):
         response = self.client.get("/rate")
         self.assertEqual(response.status_code, 429)
 
+    def test_protected_route(self):
+        response = self.client.get("/protected")
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get("/protected", headers={"Authorization": "Basic bm90LWJhc2U2NA=="})
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get("/protected", auth=("Meghna", "wrong"))
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get("/protected", auth=("Meghna", "M272"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), "Hello, Meghna")
+
+    def test_security_scheme_in_openapi(self):
+        schema = builder.app.openapi()
+        self.assertEqual(schema["components"]["securitySchemes"], {"HTTPBasic": {"type": "http", "scheme": "basic"}})
+        self.assertEqual(schema["paths"]["/protected"]["get"]["security"], [{"HTTPBasic": []}])
+
+    def test_routes_registered_once(self):
+        paths = [route.path for route in builder.app.routes]
+        for path in ("/addition", "/diff", "/rate", "/protected"):
+            self.assertEqual(paths.count(path), 1)
+
+    def test_routes_built_without_explicit_build(self):
+        unbuilt = FastApiDecoratorBuilder()
+
+        @unbuilt.api_route("late")
+        async def late() -> str:
+            return "late"
+
+        response = TestClient(unbuilt.app).get("/late")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), "late")
+
+    def test_rate_limited_path_parameters(self):
+        limited = FastApiDecoratorBuilder()
+
+        @limited.api_route("items/{item_id}", rate_limit="1/hour")
+        async def item(item_id: int) -> int:
+            return item_id
+
+        client = TestClient(limited.app)
+        # another method than the route's is not counted against its limit
+        self.assertEqual(client.post("/items/1").status_code, 405)
+        self.assertEqual(client.get("/items/1").status_code, 200)
+        self.assertEqual(client.get("/items/1").status_code, 429)
+        self.assertEqual(client.get("/items/2").status_code, 429)
+
     def test_api_configuration(self):
         self.assertTrue(builder.methodsAutomatic)
         self.assertEqual(builder.title, "FastAPI Decorator Builder")
         self.assertEqual(builder.methodsDefault, ["GET"])
 
+class TestUserCredentialsDB(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filepath = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        os.remove(self.filepath)
+        self.db = UserCredentialsDB(self.filepath)
+
+    def tearDown(self):
+        self.db.close()
+        for path in (self.filepath, self.db.log_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_validation_cache(self):
+        self.db.add_user("alice", "secret")
+        self.assertTrue(self.db.validate_user("alice", "secret"))
+        self.assertFalse(self.db.validate_user("alice", "wrong"))
+        self.assertEqual(len(self.db._validation_cache), 2)
+        # cached results are served without touching the stored hash
+        self.db.credentials["alice"] = b"garbage"
+        self.assertTrue(self.db.validate_user("alice", "secret"))
+        self.assertFalse(self.db.validate_user("alice", "wrong"))
+
+    def test_validation_cache_expiry(self):
+        db = UserCredentialsDB(self.filepath, cache_ttl=0)
+        db.add_user("alice", "secret")
+        self.assertTrue(db.validate_user("alice", "secret"))
+        # with a TTL of 0 the cached result is already expired, so the stored hash is checked again
+        db.credentials["alice"] = b"garbage"
+        self.assertFalse(db.validate_user("alice", "secret"))
+        db.close()
+
+    def test_validation_cache_eviction(self):
+        db = UserCredentialsDB(self.filepath, cache_size=2)
+        db.add_user("alice", "secret")
+        db.validate_user("alice", "first")
+        db.validate_user("alice", "second")
+        db.validate_user("alice", "first")  # now the most recently used
+        db.validate_user("alice", "third")
+        self.assertEqual(len(db._validation_cache), 2)
+        cached_digests = [digest for _, digest in db._validation_cache]
+        self.assertIn(hashlib.sha256(b"first").digest(), cached_digests)
+        self.assertNotIn(hashlib.sha256(b"second").digest(), cached_digests)
+        db.close()
+
+    def test_validation_cache_thread_safety(self):
+        db = UserCredentialsDB(self.filepath, cache_size=8)
+        db.add_user("alice", "secret")
+        db.credentials["alice"] = bcrypt.hashpw(b"secret", bcrypt.gensalt(4))
+        errors = []
+
+        def validate(worker):
+            try:
+                for attempt in range(2000):
+                    db.validate_user("alice", "secret" if attempt % 2 else "wrong%d" % (attempt % 10))
+            except Exception as exc:
+                errors.append(exc)
+
+        def clear():
+            while any(thread.is_alive() for thread in validators):
+                db._clear_validation_cache()
+
+        validators = [threading.Thread(target=validate, args=(worker,)) for worker in range(16)]
+        threads = validators + [threading.Thread(target=clear)]
+        # switch threads as often as possible so that they interleave inside validate_user
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        db.close()
+        self.assertEqual(errors, [])
+
+    def test_check_racing_a_delete_is_not_cached(self):
+        self.db.add_user("alice", "secret")
+        check_password = self.db._check_password
+        started, release = threading.Event(), threading.Event()
+
+        def blocked_check(password, hashed_password):
+            started.set()
+            release.wait()
+            return check_password(password, hashed_password)
+
+        self.db._check_password = blocked_check
+        thread = threading.Thread(target=self.db.validate_user, args=("alice", "secret"))
+        thread.start()
+        started.wait()
+        # alice is deleted while her password is being checked
+        del self.db.credentials["alice"]
+        self.db._clear_validation_cache()
+        release.set()
+        thread.join()
+        self.db._check_password = check_password
+        self.assertFalse(self.db.validate_user("alice", "secret"))
+
+    def test_argon2_and_legacy_bcrypt_hashes(self):
+        self.db.add_user("alice", "secret")
+        self.assertTrue(self.db.credentials["alice"].startswith(b"$argon2id$"))
+        self.db.credentials["bob"] = bcrypt.hashpw(b"hunter2", bcrypt.gensalt(4))
+        self.assertTrue(self.db.validate_user("bob", "hunter2"))
+        self.assertFalse(self.db.validate_user("bob", "hunter3"))
+
+    def test_users_needing_rehash(self):
+        self.db.add_user("alice", "secret")
+        self.db.credentials["bob"] = bcrypt.hashpw(b"hunter2", bcrypt.gensalt(4))
+        self.assertEqual(self.db.users_needing_rehash(), ["bob"])
+        stronger_db = UserCredentialsDB(self.filepath, time_cost=4)
+        self.assertEqual(stronger_db.users_needing_rehash(), ["alice"])
+        stronger_db.close()
+
+    def test_excessive_cost_rejected(self):
+        legacy = bcrypt.hashpw(b"hunter2", bcrypt.gensalt(4))
+        # a cost of 31 would keep bcrypt busy for hours if it were checked
+        self.db.credentials["bob"] = legacy.replace(b"$04$", b"$31$", 1)
+        self.assertFalse(self.db.validate_user("bob", "hunter2"))
+        self.db.add_user("alice", "secret")
+        self.db.credentials["alice"] = self.db.credentials["alice"].replace(b",t=3,", b",t=99,", 1)
+        self.assertFalse(self.db.validate_user("alice", "secret"))
+
+    def test_benchmark_cost(self):
+        self.assertEqual(benchmark_cost(target_ms=0), 1)
+        self.assertEqual(benchmark_cost(target_ms=float("inf"), memory_cost=64), MAX_ARGON2_TIME_COST)
+
+    def test_benchmark_cost_search(self):
+        clock = [0.0]
+
+        class FakeHasher:
+            # each unit of time cost takes 20 ms on the fake clock
+            def __init__(self, time_cost, memory_cost):
+                self.time_cost = time_cost
+
+            def hash(self, password):
+                clock[0] += self.time_cost * 0.020
+
+        with mock.patch("Auth.PasswordHasher", FakeHasher), mock.patch("Auth.time.perf_counter", lambda: clock[0]):
+            self.assertEqual(benchmark_cost(target_ms=250), 12)
+            self.assertEqual(benchmark_cost(target_ms=110), 5)
+
+    def test_log_replay_and_compaction(self):
+        self.db.add_user("alice", "secret")
+        self.db.add_user("bob", "hunter2")
+        self.assertTrue(self.db.delete_user("alice", "secret"))
+        self.assertEqual(UserCredentialsDB(self.filepath).credentials, self.db.credentials)
+        # 3 records for a single user is more than twice the number of users, so the log was compacted
+        self.assertEqual(os.path.getsize(self.db.log_path), 0)
+        with open(self.filepath) as file:
+            self.assertEqual(list(json.load(file)), ["bob"])
+
+    def test_torn_log_record(self):
+        self.db.add_users([("alice", "secret"), ("bob", "hunter2"), ("carol", "hunter3")])
+        self.db.close()
+        with open(self.db.log_path, 'ab') as file:
+            file.write(b'{"username":"dave","ha')
+        db = UserCredentialsDB(self.filepath)
+        self.assertEqual(sorted(db.credentials), ["alice", "bob", "carol"])
+        # the torn record was dropped, so the next append is not joined onto it
+        db.add_user("erin", "hunter4")
+        db.close()
+        self.db = UserCredentialsDB(self.filepath)
+        self.assertEqual(sorted(self.db.credentials), ["alice", "bob", "carol", "erin"])
+        self.assertTrue(self.db.validate_user("erin", "hunter4"))
+
+    def test_log_opened_on_first_append(self):
+        self.assertFalse(os.path.exists(self.db.log_path))
+        self.db.add_user("alice", "secret")
+        self.assertTrue(os.path.exists(self.db.log_path))
+        self.db.close()
+        # the store can still append after being closed
+        self.db.add_user("bob", "hunter2")
+        self.assertEqual(sorted(UserCredentialsDB(self.filepath).credentials), ["alice", "bob"])
+
+    def test_add_users(self):
+        self.db.add_users([("alice", "secret"), ("bob", "hunter2")])
+        self.assertTrue(self.db.validate_user("alice", "secret"))
+        self.assertTrue(self.db.validate_user("bob", "hunter2"))
+        self.assertEqual(UserCredentialsDB(self.filepath).credentials, self.db.credentials)
+
+    def test_seed_is_idempotent(self):
+        seed(self.db)
+        credentials = dict(self.db.credentials)
+        self.assertEqual(sorted(credentials), ["Meghna", "user1"])
+        seed(self.db)
+        self.assertEqual(self.db.credentials, credentials)
+
+    def test_tokens(self):
+        db = UserCredentialsDB(self.filepath, server_key=b"server-key")
+        db.add_token("service", "3f9c1e0a7b")
+        self.assertTrue(db.is_token("service"))
+        self.assertTrue(db.validate_token("service", "3f9c1e0a7b"))
+        self.assertFalse(db.validate_token("service", "3f9c1e0a7c"))
+        self.assertTrue(db.validate_user("service", "3f9c1e0a7b"))
+        db.close()
+
+    def test_basic_credentials_options(self):
+        app = FastAPI()
+
+        @app.get("/optional")
+        async def optional(credentials=Depends(BasicCredentials(auto_error=False))):
+            return credentials[0] if credentials else None
+
+        @app.get("/realm")
+        async def realm(credentials=Depends(BasicCredentials(realm="api"))):
+            return credentials[0]
+
+        client = TestClient(app)
+        response = client.get("/optional")
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json())
+        self.assertEqual(client.get("/optional", auth=("alice", "secret")).json(), "alice")
+        response = client.get("/realm")
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.headers["WWW-Authenticate"], 'Basic realm="api"')
+
+    def test_cache_cleared_on_delete(self):
+        self.db.add_user("alice", "secret")
+        self.assertTrue(self.db.validate_user("alice", "secret"))
+        self.assertTrue(self.db.delete_user("alice", "secret"))
+        self.assertFalse(self.db.validate_user("alice", "secret"))
+
 if __name__ == '__main__':
     from fastapi import Depends, Request
     from Auth import get_current_user
@@ -54,21 +333,21 @@ if __name__ == '__main__':
     ################# IMPLEMENTATION EXAMPLES  #################
 
     @builder.api_route("diff", run_server=False)
-    def difference(a: int, b: int) -> int:
+    async def difference(a: int, b: int) -> int:
         """
         Endpoint to subtract two integers.
         """
         return a-b
 
     @builder.api_route(run_server=False)
-    def addition(a: int, b: int)->int:
+    async def addition(a: int, b: int)->int:
         """
         Endpoint to add two integers.
         """
         return a+b
 
     @builder.api_route("rate", rate_limit="2/hour")
-    def example_route(request: Request)->str:
+    async def example_route(request: Request)->str:
         """
         Demonstrates a rate-limited endpoint, allowing only 2 requests per hour from the same client. 
         """
@@ -76,10 +355,11 @@ if __name__ == '__main__':
 
 
     @builder.api_route("protected", auth_required=True, run_server=False)
-    def protected_data(username: str = Depends(get_current_user)) -> str:
+    async def protected_data(username: str = Depends(get_current_user)) -> str:
         """
         Provides access to authenticated users only
         """
         return f"Hello, {username}"
 
+    builder.build()
     unittest.main()
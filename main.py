@@ -15,21 +15,21 @@ builder.configure_api({
 ################# IMPLEMENTATION EXAMPLES  #################
 
 @builder.api_route("diff", run_server=False)
-def difference(a: int, b: int) -> int:
+async def difference(a: int, b: int) -> int:
     """
     Endpoint to subtract two integers.
     """
     return a-b
 
 @builder.api_route(run_server=False)
-def addition(a: int, b: int)->int:
+async def addition(a: int, b: int)->int:
     """
     Endpoint to add two integers.
     """
     return a+b
 
 @builder.api_route("rate", rate_limit="2/hour")
-def example_route(request: Request)->str:
+async def example_route(request: Request)->str:
     """
     Demonstrates a rate-limited endpoint, allowing only 2 requests per hour from the same client. 
     """
@@ -37,7 +37,7 @@ def example_route(request: Request)->str:
 
 
 @builder.api_route("protected", auth_required=True, run_server=True)
-def protected_data(username: str = Depends(get_current_user)) -> str:
+async def protected_data(username: str = Depends(get_current_user)) -> str:
     """
     Provides access to authenticated users only
     """